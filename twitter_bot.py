@@ -3,13 +3,37 @@ functions of a twitter bot.
 It is meant to be subclassed by an other script that implements the actual
 bot specific functions."""
 
+import concurrent.futures
 import datetime
 import tweepy
+import requests
 import logging
+import logging.handlers
 import nltk
 import configparser
 import json
+import sqlite3
 import string
+import re
+import itertools
+import time
+import ahocorasick
+
+_logger = logging.getLogger(__name__)
+
+
+def _configure_logging():
+    """Sets up the log file handler on the root logger, once per process rather than once per bot.
+    It goes on the root logger so that logging calls from subclassing bot scripts and from tweepy
+    end up in the same log file, as they did with logging.basicConfig."""
+    root = logging.getLogger()
+    if root.handlers:
+        return
+    # rolls over to a new log file at midnight, so long running bots still get a log per day
+    handler = logging.handlers.TimedRotatingFileHandler("logs/twitter_bot.log", when="midnight", backupCount=30)
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
 
 
 class TwitterBot:
@@ -21,20 +45,25 @@ class TwitterBot:
             bot_id: The id of the bot.
             config_file_path: The path to the config file that contains your twitter credentials.
         """
-        self.date = datetime.datetime.today().strftime('%d_%m_%Y')
-        logging.basicConfig(filename=f"logs/twitter_bot_{self.date}.log", level=logging.INFO,
-                            format='%(asctime)s - %(levelname)s - %(message)s',
-                            filemode='a+')
-        logging.info("Twitter Bot Activated.")
+        _configure_logging()
+        _logger.info("Twitter Bot Activated.")
 
         # the twitter id of your bot
         self.bot_id = bot_id
 
+        # how many times get_mentions waits out a rate limit before giving up for this poll
+        self.max_rate_limit_retries = 3
+
         # Let's define our stop words here
         # If you're not familiar with stop words, they are the most commonly ccuring
         # words in texts, like the, a, and, of, etc.
-        self.stop_words = nltk.corpus.stopwords.words('english')
-        self.stop_words.extend(list(string.punctuation))
+        # Stored as a frozenset so that membership checks while tokenizing are O(1)
+        self.stop_words = frozenset(nltk.corpus.stopwords.words('english')).union(string.punctuation)
+        # Created once and reused for every tweet instead of building a new one per call
+        self._tokenizer = nltk.tokenize.casual.TweetTokenizer(preserve_case=False,
+                                                              reduce_len=True)
+        # URLs, handles and hashtags are stripped with this single pattern before tokenizing
+        self._noise_re = re.compile(r'https?://\S+|(?<!\w)[@#]\w+')
 
         # Let's get out twitter API up and running
         # Note that I'm importing my twitter API credentials from a config file
@@ -43,14 +72,9 @@ class TwitterBot:
 
         # Note: twitter-app-data section contains the credentials of project/app in your twitter developer account
         # while the twitter-bot-data section contains credentials or access token and secret of the bot.
-        logging.info("Initiatign Authentication Process.")
-        config = configparser.ConfigParser()
-        config.read(config_file_path)
-        bearer_token = config["twitter-app-data"]["bearer"]
-        consumer_key = config['twitter-app-data']['consumer_key']
-        consumer_secret = config['twitter-app-data']['consumer_secret']
-        access_token = config['twitter-bot-data']['access_token']
-        access_secret = config['twitter-bot-data']['access_token_secret']
+        _logger.info("Initiatign Authentication Process.")
+        bearer_token, consumer_key, consumer_secret, access_token, access_secret = \
+            self._load_credentials(config_file_path)
 
         self.api_v2 = tweepy.Client(bearer_token, consumer_key, consumer_secret,
                                     access_token, access_secret)
@@ -60,16 +84,46 @@ class TwitterBot:
         auth_v1 = tweepy.OAuthHandler(consumer_key, consumer_secret,
                                       access_token, access_secret)
         self.api_v1 = tweepy.API(auth=auth_v1)
-        logging.info("Authentication Completed.")
+        _logger.info("Authentication Completed.")
+
+        # Users data lives in sqlite so each request is a single row update
+        # instead of rewriting the whole users file.
+        self._users_db = self._connect_users_db("validation_data/users.db",
+                                                "validation_data/users_data.json")
+        self._last_seen_id = None
+
+        # Automaton for matching params values in tweets, built by set_params_dict
+        self._params_key = None
+        self._params_ac = None
+        self._params_always_matched = {}
+
+    @staticmethod
+    def _load_credentials(config_file_path: str):
+        """Reads the twitter credentials from the config file.
+        The parser is local to this function so it can be garbage collected once the credentials are extracted.
+        Args:
+            config_file_path: The path to the config file that contains your twitter credentials.
+        Returns:
+            A tuple of bearer token, consumer key, consumer secret, access token and access token secret.
+        """
+        config = configparser.ConfigParser()
+        config.read(config_file_path)
+        return (config["twitter-app-data"]["bearer"],
+                config['twitter-app-data']['consumer_key'],
+                config['twitter-app-data']['consumer_secret'],
+                config['twitter-bot-data']['access_token'],
+                config['twitter-bot-data']['access_token_secret'])
 
     def get_last_seen_tweet_id(self):
         """Gets the last seen tweet id."""
 
-        logging.info("Retrieing last seen tweet ID")
-        with open("validation_data/last_seen_tweet_id.txt", "r") as f:
-            last_seen_id = int(f.read().strip())
-            logging.info(f"last seen id: {last_seen_id}")
-            return last_seen_id
+        _logger.info("Retrieing last seen tweet ID")
+        # the file is only ever written by this bot, so after the first read we serve it from memory
+        if self._last_seen_id is None:
+            with open("validation_data/last_seen_tweet_id.txt", "rb") as f:
+                self._last_seen_id = int(f.read())
+        _logger.info("last seen id: %s", self._last_seen_id)
+        return self._last_seen_id
 
     def store_last_seen_tweet_id(self, last_seen_tweet_id: int):
         """Stores the last seen tweet id in a file.
@@ -78,12 +132,48 @@ class TwitterBot:
         Returns:
             Nothing
         """
-        logging.info("Storing last seen tweet ID")
-        last_seen_tweet_id = last_seen_tweet_id
-        with open("validation_data/last_seen_tweet_id.txt", "w") as f:
-            f.write(str(last_seen_tweet_id))
+        _logger.info("Storing last seen tweet ID")
+        self._last_seen_id = last_seen_tweet_id
+        with open("validation_data/last_seen_tweet_id.txt", "wb") as f:
+            f.write(str(last_seen_tweet_id).encode())
         return
 
+    @staticmethod
+    def _connect_users_db(db_path: str, legacy_json_path: str):
+        """Opens the users database, creating it if needed.
+        When the database is first created, records from the old users data json file are imported into it.
+        Args:
+            db_path: The path to the sqlite database file.
+            legacy_json_path: The path to the users data json file used by older versions of the bot.
+        Returns:
+            An sqlite3 connection in autocommit mode.
+        """
+        connection = sqlite3.connect(db_path, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        exists = connection.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='users'").fetchone()
+        if exists:
+            return connection
+        try:
+            with open(legacy_json_path, "r") as f:
+                users_data = json.load(f)
+        except FileNotFoundError:
+            users_data = {}
+        today = datetime.date.today().isoformat()
+        rows = [(uid, int(record['requests']), today) for uid, record in users_data.items()]
+        # the table is created and filled in one transaction, so a failed import
+        # leaves no table behind and is tried again the next time the bot starts
+        connection.execute("BEGIN")
+        try:
+            connection.execute("CREATE TABLE users (user_id TEXT PRIMARY KEY, requests INTEGER NOT NULL, day TEXT NOT NULL)")
+            if rows:
+                _logger.info("Importing users data from %s", legacy_json_path)
+                connection.executemany("INSERT INTO users (user_id, requests, day) VALUES (?, ?, ?)", rows)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return connection
+
     def validate_user(self, user_id: str):
         """Validates a user id.
         Args:
@@ -91,18 +181,16 @@ class TwitterBot:
         Returns:
             True if the user is valid, False otherwise.
             By valid we mean user has not made more than 5 requests in a day.
-            If they have, they will be put limit reached json file.
+        Note: Prefer check_and_increment when the request is going to be processed anyway.
         """
-        logging.info("Validating user")
-        with open("validation_data/users_data.json", "r") as f:
-            users_data = json.loads(f.read())
-        if str(user_id) in users_data.keys():
-            user_requests = users_data[str(user_id)]['requests']
-        # if users record doesnt exist yet then the user has made no requests
+        _logger.info("Validating user")
+        row = self._users_db.execute("SELECT requests FROM users WHERE user_id = ? AND day = ?",
+                                     (str(user_id), datetime.date.today().isoformat())).fetchone()
+        # if users record for today doesnt exist yet then the user has made no requests today
         # hence they are valid. As for creating record we do so with update validation data method
-        else:
+        if row is None:
             return True
-        if int(user_requests) >= 5:
+        if row[0] >= 5:
             return False
         else:
             return True
@@ -111,19 +199,37 @@ class TwitterBot:
         """Updates the validation data.
         Args:
             user_id: The id of the user to update.
+        Note: Prefer check_and_increment when the user was just validated.
         """
-        logging.info("Updating validation data")
-        with open("validation_data/users_data.json", "r") as f:
-            users_data = json.loads(f.read())
-        if str(user_id) in users_data.keys():
-            users_data[str(user_id)]['requests'] += 1
-        else:
-            new_user_data = {f"{user_id}": {'requests': 1}}
-            users_data = {**users_data, **new_user_data}
-        with open("validation_data/users_data.json", "w") as f:
-            f.write(json.dumps(users_data))
+        _logger.info("Updating validation data")
+        # a record from an earlier day starts counting from 1 again
+        self._users_db.execute("INSERT INTO users (user_id, requests, day) VALUES (?, 1, ?) "
+                               "ON CONFLICT(user_id) DO UPDATE SET "
+                               "requests = CASE WHEN day = excluded.day THEN requests + 1 ELSE 1 END, "
+                               "day = excluded.day",
+                               (str(user_id), datetime.date.today().isoformat()))
         return
 
+    def check_and_increment(self, user_id: str):
+        """Validates a user and, if valid, counts this request against their limit.
+        Does the work of validate_user followed by update_validation_data
+        in a single statement, so prefer this over calling the two separately.
+        Args:
+            user_id: The id of the user to validate.
+        Returns:
+            True if the user is valid (and their request count was incremented), False otherwise.
+        """
+        _logger.info("Validating user and updating validation data")
+        # the update only goes through if the user is under the limit for today,
+        # so whether a row changed tells us whether the user is valid
+        cursor = self._users_db.execute("INSERT INTO users (user_id, requests, day) VALUES (?, 1, ?) "
+                                        "ON CONFLICT(user_id) DO UPDATE SET "
+                                        "requests = CASE WHEN day = excluded.day THEN requests + 1 ELSE 1 END, "
+                                        "day = excluded.day "
+                                        "WHERE day != excluded.day OR requests < 5",
+                                        (str(user_id), datetime.date.today().isoformat()))
+        return cursor.rowcount > 0
+
     # this func above was written by Github Copilot. Good bot!
 
     def get_mentions(self):
@@ -131,19 +237,37 @@ class TwitterBot:
         Returns:
             A list of mentions, along with meta data about users.
         """
-        logging.info("Retrieving mentions")
+        _logger.info("Retrieving mentions")
         last_seen_tweet_id = self.get_last_seen_tweet_id()
         # the twitter id of the TweetsCloudBot
         bot_id = self.bot_id
-        try:
-            mentions = self.api_v2.get_users_mentions(bot_id, since_id=last_seen_tweet_id, expansions="author_id",
-                                                      user_fields=["username"])
-            mentions_data = mentions.data
-            users_metadata = mentions.includes["users"]
-            return mentions_data, users_metadata
-        except:
-            logging.error("Couldn't retrieve mentions")
+        for attempt in range(self.max_rate_limit_retries + 1):
+            try:
+                mentions = self.api_v2.get_users_mentions(bot_id, since_id=last_seen_tweet_id, expansions="author_id",
+                                                          user_fields=["username"])
+                break
+            except tweepy.errors.TooManyRequests as e:
+                if attempt == self.max_rate_limit_retries:
+                    _logger.error("Rate limit still reached after %s retries, giving up on mentions", attempt)
+                    return [], []
+                # twitter tells us when the rate limit window resets, so we sleep until then and retry.
+                # A missing or broken header falls back to a minute, and we never wait longer than one window.
+                try:
+                    reset = int(e.response.headers['x-rate-limit-reset'])
+                except (KeyError, TypeError, ValueError):
+                    reset = time.time() + 60
+                wait = min(max(0, reset - time.time()), 15 * 60)
+                _logger.warning("Rate limit reached, retrying mentions in %.0f seconds", wait)
+                time.sleep(wait)
+            except (tweepy.errors.TweepyException, requests.exceptions.RequestException):
+                _logger.exception("Couldn't retrieve mentions")
+                return [], []
+        # no new mentions since the last seen tweet
+        if not mentions.data:
             return [], []
+        mentions_data = mentions.data
+        users_metadata = mentions.includes.get("users", [])
+        return mentions_data, users_metadata
 
     def fetch_tweets(self, user_id: str):
         """Fetches tweets from a given username.
@@ -152,12 +276,35 @@ class TwitterBot:
         Returns:
             A list of tweets.
         """
-        logging.info("Fetching tweets")
+        _logger.info("Fetching tweets")
         # user = self.api_v2.get_user(username)
         tweets = self.api_v2.get_users_tweets(id=user_id, max_results=100)
         tweets = tweets.data
         return tweets
 
+    def fetch_tweets_bulk(self, user_ids: list, max_workers: int = 8):
+        """Fetches tweets for several users at once.
+        Each user's timeline is a separate request, so we run them concurrently
+        instead of waiting on each one in turn.
+        Args:
+            user_ids: A list of ids of the users to fetch tweets from.
+            max_workers: The maximum number of requests to run at the same time.
+        Returns:
+            A dict mapping each user id to their list of tweets, in the same order as user_ids.
+            Users whose tweets couldn't be fetched are mapped to None, so one failure doesn't lose the rest.
+        """
+        _logger.info("Fetching tweets in bulk")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {user_id: executor.submit(self.fetch_tweets, user_id) for user_id in user_ids}
+        tweets = {}
+        for user_id, future in futures.items():
+            try:
+                tweets[user_id] = future.result()
+            except (tweepy.errors.TweepyException, requests.exceptions.RequestException):
+                _logger.exception("Couldn't fetch tweets of user %s", user_id)
+                tweets[user_id] = None
+        return tweets
+
     def preprocess_and_tokenize_tweets(self, tweets: list):
         """Preprocesses and tokenizes tweets.
         Args:
@@ -166,16 +313,14 @@ class TwitterBot:
         Returns:
             A list of words or tokens.
         """
-        all_words = []
-        for tweet in tweets:
-            tweet_text = tweet.text
-            words = nltk.tokenize.casual.casual_tokenize(tweet_text,
-                                                         preserve_case=False,
-                                                         reduce_len=True,
-                                                         strip_handles=True)
-            words = [word for word in words if word not in self.stop_words]
-            all_words.extend(words)
-        return all_words
+        texts = [tweet.text for tweet in tweets]
+        return list(itertools.chain.from_iterable(self._tokenize_and_filter(text) for text in texts))
+
+    def _tokenize_and_filter(self, tweet_text: str):
+        """Tokenizes a tweet's text, yielding only the words that aren't stop words or punctuation."""
+        stop_words = self.stop_words
+        tweet_text = self._noise_re.sub(' ', tweet_text)
+        return (word for word in self._tokenizer.tokenize(tweet_text) if word not in stop_words)
 
     def reply_with_limit_reached(self, tweet_id: str, user_screen_name: str):
         """Replies to a tweet.
@@ -184,7 +329,7 @@ class TwitterBot:
             user_screen_name: The screen name of the user.
 
         """
-        logging.info("Replying with limit reached message")
+        _logger.info("Replying with limit reached message")
         reply_text = f"Hi {user_screen_name}, Sorry, but you've reached your daily limit of " \
                      "5 requests per day. " \
                      "Please try again tomorrow."
@@ -199,18 +344,49 @@ class TwitterBot:
         Returns:
             True or False based on whether the mention/tweet includes required input Make Tweets Cloud.
             """
-        tweet_text = str(tweet_text).lower()
-        if type(required_input) == list:
-            for r_input in required_input:
-                if r_input in required_input:
-                    return True
-            return False
+        return self._contains_required_input(required_input, str(tweet_text).lower())
+
+    @staticmethod
+    def _contains_required_input(required_input, tweet_text: str):
+        """Checks already lowercased tweet text for the required input."""
+        if isinstance(required_input, str):
+            return required_input in tweet_text
+        elif isinstance(required_input, (list, tuple, set, frozenset)):
+            return any(r_input in tweet_text for r_input in required_input)
+        return False
 
-        elif type(required_input) == str:
-            if required_input in tweet_text:
-                return True
-            else:
-                return False
+    @staticmethod
+    def _params_snapshot(params_dict: dict):
+        """Returns a hashable copy of params_dict's contents, used to tell when the automaton is out of date."""
+        return tuple((param, tuple(values)) for param, values in params_dict.items())
+
+    def set_params_dict(self, params_dict: dict):
+        """Builds the automaton used by get_params_from_tweet to match params values.
+        Args:
+            params_dict: A dict of params that the bot expects to see, in the format
+            described in get_params_from_tweet.
+        """
+        automaton = ahocorasick.Automaton()
+        # an empty value is in every tweet, so it can't go in the automaton and is kept aside instead
+        always_matched = {}
+        for param, values in params_dict.items():
+            for priority, value in enumerate(values):
+                if value == '':
+                    always_matched.setdefault(param, (priority, value))
+                # different params may share a value, so each word maps to a list of candidates
+                elif value in automaton:
+                    automaton.get(value).append((param, priority, value))
+                else:
+                    automaton.add_word(value, [(param, priority, value)])
+        if len(automaton) > 0:
+            automaton.make_automaton()
+        else:
+            # an automaton with no words can't be searched
+            automaton = None
+        self._params_key = self._params_snapshot(params_dict)
+        self._params_ac = automaton
+        self._params_always_matched = always_matched
+        return
 
     def get_params_from_tweet(self, tweet_text: str = None,
                               params_dict: dict = None):
@@ -222,15 +398,27 @@ class TwitterBot:
         Returns:
             A dictionary of parameters.
         """
-        logging.info("Extracting parameters from tweet")
-        params = {}
-        tweet_text = tweet_text.lower()
+        _logger.info("Extracting parameters from tweet")
+        return self._match_params(tweet_text.lower(), params_dict)
+
+    def _match_params(self, tweet_text: str, params_dict: dict):
+        """Matches params values in already lowercased tweet text. See get_params_from_tweet."""
+        # the automaton is rebuilt only when the params or their values actually change,
+        # whether the bot passes a new dict each time or edits the same one in place
+        if self._params_snapshot(params_dict) != self._params_key:
+            self.set_params_dict(params_dict)
+        params = {param: value for param, (_, value) in self._params_always_matched.items()}
+        priorities = {param: priority for param, (priority, _) in self._params_always_matched.items()}
+        if self._params_ac is None:
+            return params
 
-        for param in params_dict.keys():
-            for value in params_dict[param]:
-                if value in tweet_text:
+        # A single pass over the tweet finds every allowed value that occurs in it.
+        # When several values of a param occur, the one listed first in params_dict wins.
+        for _, candidates in self._params_ac.iter(tweet_text):
+            for param, priority, value in candidates:
+                if param not in priorities or priority < priorities[param]:
+                    priorities[param] = priority
                     params[param] = value
-                    break
         return params
 
         # params["mode"] = "default"
@@ -255,9 +443,29 @@ class TwitterBot:
         #     params["border"] = True
         # return params
 
+    def parse_tweet(self, tweet_text: str, required_input=None, params_dict: dict = None):
+        """Validates the input of a tweet and extracts its parameters.
+        Does the work of validate_input followed by get_params_from_tweet, lowercasing the tweet text only once.
+        Args:
+            tweet_text: The text of the tweet.
+            required_input: The input that the bot requires to run. Can be a string or list of strings.
+            params_dict: A dict of params that the bot expects to see, in the format
+            described in get_params_from_tweet.
+        Returns:
+            A tuple of whether the tweet includes the required input, and a dictionary of parameters.
+            The parameters are only extracted when the input is valid, otherwise the dictionary is empty.
+        """
+        tweet_text = str(tweet_text).lower()
+        if not self._contains_required_input(required_input, tweet_text):
+            return False, {}
+        _logger.info("Extracting parameters from tweet")
+        return True, self._match_params(tweet_text, params_dict)
+
     def bot_handler(self):
         """Handles the bot.
         To be overwritten by the child class as bots serve different purposes
         and thus must be handled in tandem.
+        Tip: Bots that need both validate_input and get_params_from_tweet for a tweet
+        can call parse_tweet instead, which lowercases the tweet text only once.
         """
         pass